@@ -1,46 +1,84 @@
 #!/usr/bin/env python3
 
+import atexit
 import cv2
 import tensorflow as tf
+import io
 import os
-from imutils.video import WebcamVideoStream  # For more performant non-blocking multi-threaded OpenCV Web Camera Stream
-from scipy.misc import imread
+import numpy as np
 from lib.mtcnn import detect_face  # for MTCNN face detection
-from flask import Flask, request, render_template, Response
+from flask import Flask, Request, request, render_template, Response
 from flask_socketio import SocketIO
 from werkzeug.utils import secure_filename
 from waitress import serve
+from concurrent.futures import ThreadPoolExecutor
 from utils import (
     load_model,
     get_face,
     get_faces_live,
-    forward_pass,
+    EmbeddingBatcher,
+    EmbeddingCache,
+    get_image_hash,
+    get_model_key,
     save_embedding,
-    load_embeddings,
-    identify_face,
+    EmbeddingGallery,
     allowed_file,
+    has_image_signature,
     remove_file_extension,
     save_image
 )
 
+
+class InMemoryRequest(Request):
+    """Request keeping uploaded image files in memory instead of spooling large uploads to temporary files on disk,
+    the image bytes are read once into memory for the face detection anyway."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # reject uploads above 16 MB before buffering them
 app.secret_key = os.urandom(24)
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 socketio = SocketIO(app)
 uploads_path = os.path.join(APP_ROOT, 'uploads')
 embeddings_path = os.path.join(APP_ROOT, 'embeddings')
-allowed_set = set(['png', 'jpg', 'jpeg'])  # allowed image formats for upload
+allowed_set = frozenset(['png', 'jpg', 'jpeg'])  # allowed image formats for upload
    
 
  # Load FaceNet model and configure placeholders for forward pass into the FaceNet model to calculate embeddings
 model_path = 'model/20170512-110547.pb'
-facenet_model = load_model(model_path)
+    # FaceNet precision: 'FP32' runs the plain Tensorflow graph, 'FP16' or 'INT8' convert it with TensorRT (TF-TRT).
+    # TensorRT needs the GPU wheel 'tensorflow-gpu==1.12.2' instead of 'tensorflow' from requirements.txt, together
+    # with CUDA 9.0, cuDNN 7 and the TensorRT 4 runtime libraries; enable it with FACENET_PRECISION=FP16.
+facenet_precision = os.environ.get('FACENET_PRECISION', 'FP32')
+max_batch_size = 16  # maximum number of concurrent face images embedded in one FaceNet forward pass
+    # GPU options are fixed at the first GPU initialization of the process, the TensorRT conversion if it runs
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
+if 'GPU_MEMORY_FRACTION' in os.environ:
+    # Cap the GPU memory of this process so several gunicorn worker processes can share one GPU
+    config.gpu_options.per_process_gpu_memory_fraction = float(os.environ['GPU_MEMORY_FRACTION'])
+facenet_model = load_model(
+    model_path,
+    precision=facenet_precision,
+    max_batch_size=max_batch_size,
+    calibration_path=uploads_path,
+    session_config=config
+)
 image_size = 160
+    # Longest image side the MTCNN face detection of uploads runs on, e.g. 640 for faster detection on large photos
+    # at the cost of missing faces smaller than 60 pixels; 0 (default) detects on the full resolution image
+mtcnn_max_detection_size = int(os.environ.get('MTCNN_MAX_DETECTION_SIZE', 0)) or None
 images_placeholder = tf.get_default_graph().get_tensor_by_name("input:0")
 embeddings = tf.get_default_graph().get_tensor_by_name("embeddings:0")
-phase_train_placeholder = tf.get_default_graph().get_tensor_by_name("phase_train:0")
+try:
+    phase_train_placeholder = tf.get_default_graph().get_tensor_by_name("phase_train:0")
+except KeyError:
+    # 'phase_train:0' was folded to False by the TensorRT optimization
+    phase_train_placeholder = None
 
     # Initiate persistent FaceNet model in memory
 facenet_persistent_session = tf.Session(graph=facenet_model, config=config)
@@ -48,6 +86,97 @@ facenet_persistent_session = tf.Session(graph=facenet_model, config=config)
     # Create Multi-Task Cascading Convolutional (MTCNN) neural networks for Face Detection
 pnet, rnet, onet = detect_face.create_mtcnn(sess=facenet_persistent_session, model_path=None)
 
+    # Batch concurrent FaceNet forward passes from the request threads into single session runs
+embedding_batcher = EmbeddingBatcher(
+    session=facenet_persistent_session,
+    images_placeholder=images_placeholder,
+    phase_train_placeholder=phase_train_placeholder,
+    embeddings=embeddings,
+    image_size=image_size,
+    max_batch_size=max_batch_size
+)
+
+    # Load the stored embeddings once into an in-memory gallery matrix for identification
+embedding_gallery = EmbeddingGallery(embeddings_path=embeddings_path)
+
+    # Cache of face crops and embeddings keyed by image file content for duplicate or retried uploads
+embedding_cache = EmbeddingCache(
+    cache_path=os.path.join(embeddings_path, '.cache'),
+    model_key=get_model_key(model_path=model_path, graph=tf.get_default_graph())
+)
+
+    # Background thread writing uploaded faces and embeddings to disk off the request thread, a single thread keeps
+    # the writes in upload order so an older upload of the same filename never overwrites a newer one
+io_pool = ThreadPoolExecutor(max_workers=1)
+atexit.register(io_pool.shutdown)
+
+    # Rendered html of the pages and status messages without per-request content
+rendered_templates = {}
+
+
+def render_cached_template(template_name_or_list, **context):
+    """Renders a template whose context is fixed (static pages and status messages) on its first request and
+    serves the cached html afterwards. Rendering is deferred to a request so 'url_for' resolves as usual.
+
+    Args:
+        template_name_or_list: name of the template to be rendered.
+        context: fixed variables of the template, e.g. the status message.
+
+    Returns:
+        html: (string) the rendered template.
+    """
+    key = (template_name_or_list, tuple(sorted(context.items())))
+    html = rendered_templates.get(key)
+    if html is None:
+        html = render_template(template_name_or_list=template_name_or_list, **context)
+        rendered_templates[key] = html
+
+    return html
+
+
+def embed_image_file(buf, persist=False):
+    """Detects the human face in an uploaded image file and computes its embedding, unless the same image file
+    contents were already processed and are found in the embedding cache.
+
+    Args:
+        buf: (bytes) raw contents of the uploaded image file.
+        persist: (boolean) also store the result in the on-disk embedding cache, written in the background.
+
+    Returns:
+        img: cropped 160 x 160 face image, None if no human face was detected.
+        embedding: (numpy array) embedding of the face image, None if no human face was detected.
+    """
+    image_hash = get_image_hash(buf)
+    cached = embedding_cache.get(image_hash)
+    if cached is not None:
+        return cached
+
+    # Decode image file as numpy array of RGB dimension (OpenCV decodes to BGR)
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    # Detect and crop a 160 x 160 image containing a human face in the image file
+    img = get_face(
+        img=img,
+        pnet=pnet,
+        rnet=rnet,
+        onet=onet,
+        image_size=image_size,
+        max_detection_size=mtcnn_max_detection_size
+    )
+
+    embedding = None
+    if img is not None:
+        embedding = embedding_batcher.submit(img=img).result()
+
+    embedding_cache.put(image_hash, face_img=img, embedding=embedding)
+    if persist:
+        io_pool.submit(embedding_cache.persist, image_hash, face_img=img, embedding=embedding)
+
+    return img, embedding
+
 
 @app.route('/upload', methods=['POST', 'GET'])
 def get_image():
@@ -60,7 +189,7 @@ def get_image():
 
     if request.method == 'POST':
         if 'file' not in request.files:
-            return render_template(
+            return render_cached_template(
                 template_name_or_list="warning.html",
                 status="No 'file' field in POST request!"
             )
@@ -69,66 +198,54 @@ def get_image():
         filename = file.filename
 
         if filename == "":
-            return render_template(
+            return render_cached_template(
                 template_name_or_list="warning.html",
                 status= "No selected file!"
             )
 
         if file and allowed_file(filename=filename, allowed_set=allowed_set):
-            filename = secure_filename(filename=filename)
-
+            if not has_image_signature(stream=file.stream, filename=filename):
+                return render_cached_template(
+                    template_name_or_list="warning.html",
+                    status="File contents are not a valid PNG or JPEG image!"
+                )
 
+            filename = secure_filename(filename=filename)
 
-            
-            # Read image file as numpy array of RGB dimension
-            img = imread(name=file, mode='RGB')
-
-            # Detect and crop a 160 x 160 image containing a human face in the image file
-            img = get_face(
-                img=img,
-                pnet=pnet,
-                rnet=rnet,
-                onet=onet,
-                image_size=image_size
-            )
+            # Detect and crop a 160 x 160 image containing a human face in the image file, then embed it
+            img, embedding = embed_image_file(buf=file.read(), persist=True)
 
             # If a human face is detected
             if img is not None:
 
-                embedding = forward_pass(
-                    img=img,
-                    session=facenet_persistent_session,
-                    images_placeholder=images_placeholder,
-                    embeddings=embeddings,
-                    phase_train_placeholder=phase_train_placeholder,
-                    image_size=image_size
-                )
-                # Save cropped face image to 'uploads/' folder
-                save_image(img=img, filename=filename, uploads_path=uploads_path)
+                # Save cropped face image to 'uploads/' folder in the background
+                io_pool.submit(save_image, img=img, filename=filename, uploads_path=uploads_path)
 
                 # Remove file extension from image filename for numpy file storage being based on image filename
                 filename = remove_file_extension(filename=filename)
 
-                # Save embedding to 'embeddings/' folder
-                save_embedding(
+                # Save embedding to 'embeddings/' folder in the background
+                io_pool.submit(
+                    save_embedding,
                     embedding=embedding,
                     filename=filename,
-                    embeddings_path=embeddings_path
+                    embeddings_path=embeddings_path,
+                    gallery=embedding_gallery
                 )
 
-                return render_template(
+                return render_cached_template(
                     template_name_or_list="upload_result.html",
                     status="Image uploaded and embedded successfully!"
                 )
 
             else:
-                return render_template(
+                return render_cached_template(
                     template_name_or_list="upload_result.html",
                     status="Image upload was unsuccessful! No human face was detected!"
                 )
 
     else:
-        return render_template(
+        return render_cached_template(
             template_name_or_list="warning.html",
             status="POST HTTP method required!"
         )
@@ -143,7 +260,7 @@ def predict_image():
     """
     if request.method == 'POST':
         if 'file' not in request.files:
-            return render_template(
+            return render_cached_template(
                 template_name_or_list="warning.html",
                 status="No 'file' field in POST request!"
             )
@@ -152,43 +269,27 @@ def predict_image():
         filename = file.filename
 
         if filename == "":
-            return render_template(
+            return render_cached_template(
                 template_name_or_list="warning.html",
                 status="No selected file!"
             )
 
         if file and allowed_file(filename=filename, allowed_set=allowed_set):
-            # Read image file as numpy array of RGB dimension
-            img = imread(name=file, mode='RGB')
-
-            # Detect and crop a 160 x 160 image containing a human face in the image file
-            img = get_face(
-                img=img,
-                pnet=pnet,
-                rnet=rnet,
-                onet=onet,
-                image_size=image_size
-            )
+            if not has_image_signature(stream=file.stream, filename=filename):
+                return render_cached_template(
+                    template_name_or_list="warning.html",
+                    status="File contents are not a valid PNG or JPEG image!"
+                )
+
+            # Detect and crop a 160 x 160 image containing a human face in the image file, then embed it
+            img, embedding = embed_image_file(buf=file.read())
 
             # If a human face is detected
             if img is not None:
 
-                embedding = forward_pass(
-                    img=img,
-                    session=facenet_persistent_session,
-                    images_placeholder=images_placeholder,
-                    embeddings=embeddings,
-                    phase_train_placeholder=phase_train_placeholder,
-                    image_size=image_size
-                )
-
-                embedding_dict = load_embeddings()
-                if embedding_dict:
+                if len(embedding_gallery) > 0:
                     # Compare euclidean distance between this embedding and the embeddings in 'embeddings/'
-                    identity = identify_face(
-                        embedding=embedding,
-                        embedding_dict=embedding_dict
-                    )
+                    identity = embedding_gallery.identify(embedding=embedding)
 
                     return render_template(
                         template_name_or_list='predict_result.html',
@@ -196,18 +297,18 @@ def predict_image():
                     )
 
                 else:
-                    return render_template(
+                    return render_cached_template(
                         template_name_or_list='predict_result.html',
                         identity="No embedding files detected! Please upload image files for embedding!"
                     )
 
             else:
-                return render_template(
+                return render_cached_template(
                     template_name_or_list='predict_result.html',
                     identity="Operation was unsuccessful! No human face was detected!"
                 )
     else:
-        return render_template(
+        return render_cached_template(
             template_name_or_list="warning.html",
             status="POST HTTP method required!"
         )
@@ -241,23 +342,36 @@ def predict_image():
 
 def get_frame():
 
-    embedding_dict = load_embeddings()
-    if embedding_dict:
+    if len(embedding_gallery) > 0:
         try:
-            cap = cv2.VideoCapture(0)
+            # Capture MJPEG frames through V4L2 so the camera compresses them and OpenCV decodes them natively,
+            # falling back to the default backend on platforms without V4L2
+            cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+            if not cap.isOpened():
+                cap = cv2.VideoCapture(0)
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
             cap.set(cv2.CAP_PROP_FRAME_WIDTH, 500)
             cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 500)
-    
+
+            # Frame buffers reused for every frame instead of allocating new arrays
+            raw_frame = None
+            frame = None
+
             while True:
         #get camera frame
          
             
-                ret, frame = cap.read()  # Read frame
+                ret, raw_frame = cap.read(raw_frame)  # Read frame into the reused buffer
+                if not ret:
+                    break
         #print(frame)
         
        
                 # Resize frame to half its size for faster computation
-                frame = cv2.resize(src=frame, dsize= (0,0) , fx=0.8, fy=0.8)
+                if frame is None:
+                    frame = cv2.resize(src=raw_frame, dsize=(0, 0), fx=0.8, fy=0.8)
+                else:
+                    cv2.resize(src=raw_frame, dsize=(frame.shape[1], frame.shape[0]), dst=frame)
 
 
     
@@ -282,27 +396,18 @@ def get_frame():
         
 
                     if faces:
+                        # Queue every face of the frame at once so they are embedded in a single batch
+                        face_futures = [embedding_batcher.submit(img=face_img) for face_img in faces]
                         for i in range(len(faces)):
-                            face_img = faces[i]
                             rect = rects[i]
 
                             # Scale coordinates of face locations by the resize ratio
                             rect = [coordinate for coordinate in rect]
 
-                            face_embedding = forward_pass(
-                                    img=face_img,
-                                    session=facenet_persistent_session,
-                                    images_placeholder=images_placeholder,
-                                    embeddings=embeddings,
-                                    phase_train_placeholder=phase_train_placeholder,
-                                    image_size=image_size
-                                )
+                            face_embedding = face_futures[i].result()
 
                                 # Compare euclidean distance between this embedding and the embeddings in 'embeddings/'
-                            identity = identify_face(
-                                    embedding=face_embedding,
-                                    embedding_dict=embedding_dict
-                                )
+                            identity = embedding_gallery.identify(embedding=face_embedding)
 
                             cv2.rectangle(
                                     img=frame,
@@ -325,9 +430,6 @@ def get_frame():
                                     lineType=cv2.LINE_AA
                                 )
         
-
-                        ret, jpeg = cv2.imencode('.jpg', frame)
-        
                     ret, jpeg = cv2.imencode('.jpg', frame)
                     yield (b'--frame\r\n'
                         b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n\r\n')
@@ -340,6 +442,9 @@ def get_frame():
         except Exception as e:
             print(e)
 
+        finally:
+            cap.release()
+
 
 
   #      
@@ -357,7 +462,7 @@ def get_frame():
 @app.route("/")
 def index_page():
     """Renders the 'index.html' page for manual image file uploads."""
-    return render_template(template_name_or_list="index.html")
+    return render_cached_template(template_name_or_list="index.html")
 
 @app.route("/video_feed", methods=["GET"])
 def video_feed():
@@ -369,13 +474,10 @@ def video_feed():
 @app.route("/predict")
 def predict_page():
     """Renders the 'predict.html' page for manual image file uploads for prediction."""
-    return render_template(template_name_or_list="predict.html")
+    return render_cached_template(template_name_or_list="predict.html")
 
 
 if __name__ == '__main__':
 
-    # Start flask application on waitress WSGI server
-    socketio.run(app)
-    
-    
-    
+    # Start flask application on waitress WSGI server, in production run: gunicorn -k gthread --threads 8 app:app
+    serve(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), threads=8)
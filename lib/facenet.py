@@ -34,11 +34,15 @@ import numpy as np
 import re
 
 
-def prewhiten(x):
+def prewhiten(x, out=None):
+    # Single float32 buffer: subtract the mean while converting, derive the std from the centered values with one
+    # dot product and scale in-place, instead of allocating a new array for every step
     mean = np.mean(x)
-    std = np.std(x)
+    y = np.subtract(x, mean, out=out, dtype=np.float32)
+    flat = y.reshape(-1)
+    std = np.sqrt(np.dot(flat, flat) / flat.size)
     std_adj = np.maximum(std, 1.0 / np.sqrt(x.size))
-    y = np.multiply(np.subtract(x, mean), 1 / std_adj)
+    y *= 1 / std_adj
 
     return y
 
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 
+import cv2
 import tensorflow as tf
 import numpy as np
 import glob
+import hashlib
+import json
 import os
+import queue
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from tensorflow.python.platform import gfile
 from lib.facenet import get_model_filenames
 from lib.mtcnn.detect_face import detect_face  # face detection
-from lib.facenet import load_image
+from lib.facenet import load_image, prewhiten, crop, to_rgb
 from scipy.misc import imresize, imsave
-from collections import defaultdict
-from flask import flash
+from collections import OrderedDict
+
+try:
+    import fcntl  # file locking of the embeddings gallery across processes, not available on Windows
+except ImportError:
+    fcntl = None
 
 
 def allowed_file(filename, allowed_set):
@@ -30,6 +44,33 @@ def allowed_file(filename, allowed_set):
     return check
 
 
+# Leading magic bytes of the allowed image formats, keyed by filename extension
+image_signatures = {
+    'png': b'\x89PNG\r\n\x1a\n',
+    'jpg': b'\xff\xd8\xff',
+    'jpeg': b'\xff\xd8\xff'
+}
+
+
+def has_image_signature(stream, filename):
+    """Checks if the first bytes of the uploaded file match the image format claimed by its filename extension,
+    without reading the rest of the file.
+
+    Args:
+        stream: file stream of the uploaded file, rewound to its start afterwards.
+        filename: filename of the uploaded file.
+
+    Returns:
+        check: boolean value representing if the file contents start with the signature of its image format.
+    """
+    signature = image_signatures.get(filename.rsplit('.', 1)[-1].lower())
+    head = stream.read(8)
+    stream.seek(0)
+    check = signature is not None and head.startswith(signature)
+
+    return check
+
+
 def remove_file_extension(filename):
     """Returns image filename without the file extension for file storage purposes.
     
@@ -44,6 +85,163 @@ def remove_file_extension(filename):
     return filename
 
 
+def get_image_hash(buf):
+    """Returns the content hash of an uploaded image file, used as key of the embedding cache.
+
+    Args:
+        buf: (bytes) raw contents of the uploaded image file.
+
+    Returns:
+        image_hash: (string) hexadecimal blake2b digest of the image file contents.
+    """
+    image_hash = hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+    return image_hash
+
+
+def get_model_key(model_path, graph):
+    """Returns a short key identifying the loaded FaceNet model, so embeddings computed by another model file or in
+    another precision are not served from the embedding cache.
+
+    The precision is read from the TensorRT engines of the graph, since the TensorRT conversion may have fallen back
+    to a different precision than the requested one.
+
+    Args:
+        model_path: path of the frozen FaceNet model protocol buffer file.
+        graph: Tensorflow graph holding the loaded FaceNet model.
+
+    Returns:
+        model_key: (string) hexadecimal digest of the model file identity and its precision.
+    """
+    precision = 'FP32'
+    for op in graph.get_operations():
+        if op.type == 'TRTEngineOp':
+            precision = op.get_attr('precision_mode')
+            if isinstance(precision, bytes):
+                precision = precision.decode()
+            break
+
+    stat = os.stat(model_path)
+    model_id = '%s-%d-%d-%s' % (os.path.basename(model_path), stat.st_size, stat.st_mtime_ns, precision)
+    model_key = hashlib.blake2b(model_id.encode(), digest_size=8).hexdigest()
+
+    return model_key
+
+
+class EmbeddingCache(object):
+    """Least recently used cache of the cropped face image and the embedding computed for an image file, keyed by the
+    content hash of the image file so duplicate or retried uploads skip the MTCNN and FaceNet models entirely.
+
+    Entries stored with persist() are also written to '<cache_path>/<model_key>/<image_hash>.npz' and survive
+    restarts; the oldest files are evicted beyond 'max_disk_entries', and the folders of other models are removed.
+    """
+
+    def __init__(self, cache_path, model_key, max_size=256, max_disk_entries=1024):
+        """
+        Args:
+            cache_path: absolute path of the on-disk cache folder: default = 'embeddings/.cache/'.
+            model_key: (string) key of the loaded FaceNet model, see get_model_key().
+            max_size: (int) maximum number of entries kept in memory.
+            max_disk_entries: (int) maximum number of entries kept in the on-disk cache folder.
+        """
+        self.cache_path = os.path.join(cache_path, model_key)
+        self.max_size = max_size
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_path, exist_ok=True)
+
+        # Embeddings of other models are never served again
+        for name in os.listdir(cache_path):
+            path = os.path.join(cache_path, name)
+            if name != model_key and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def get(self, image_hash):
+        """Looks up the cached result of an image file.
+
+        Args:
+            image_hash: (string) content hash of the image file.
+
+        Returns:
+            entry: tuple of the cropped face image and its embedding, (None, None) if no human face was detected in
+                   the image file, or None on a cache miss.
+        """
+        with self._lock:
+            if image_hash in self._entries:
+                self._entries.move_to_end(image_hash)
+                return self._entries[image_hash]
+
+        path = os.path.join(self.cache_path, image_hash + '.npz')
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as data:
+                    entry = (data['face'], data['embedding'])
+                os.utime(path)  # mark as recently used for the on-disk eviction
+                self._remember(image_hash, entry)
+                return entry
+
+            except Exception as e:
+                print(str(e))
+
+        return None
+
+    def put(self, image_hash, face_img, embedding):
+        """Stores the result computed for an image file in memory.
+
+        Args:
+            image_hash: (string) content hash of the image file.
+            face_img: cropped face image (numpy array), None if no human face was detected.
+            embedding: (numpy array) embedding of the face image, None if no human face was detected.
+        """
+        self._remember(image_hash, (face_img, embedding))
+
+    def persist(self, image_hash, face_img, embedding):
+        """Writes the result computed for an image file to the on-disk cache folder.
+
+        Args:
+            image_hash: (string) content hash of the image file.
+            face_img: cropped face image (numpy array), None if no human face was detected.
+            embedding: (numpy array) embedding of the face image, None if no human face was detected.
+        """
+        if face_img is not None:
+            try:
+                path = os.path.join(self.cache_path, image_hash + '.npz')
+                tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, face=face_img, embedding=embedding)
+                os.replace(tmp_path, path)
+                self._evict()
+            except Exception as e:
+                print(str(e))
+
+    def _evict(self):
+        # Remove the least recently used files beyond the on-disk capacity
+        paths = glob.glob(os.path.join(self.cache_path, '*.npz'))
+        if len(paths) <= self.max_disk_entries:
+            return
+
+        def mtime(path):
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                return 0
+
+        paths.sort(key=mtime)
+        for path in paths[:len(paths) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _remember(self, image_hash, entry):
+        with self._lock:
+            self._entries[image_hash] = entry
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
 def save_image(img, filename, uploads_path):
     """Saves an image file to the 'uploads' folder.
 
@@ -54,24 +252,203 @@ def save_image(img, filename, uploads_path):
     """
     try:
         imsave(os.path.join(uploads_path, filename), arr=np.squeeze(img))
-        flash("Image saved!")
     except Exception as e:
         print(str(e))
 
         return str(e)
 
 
-def load_model(model):
+def get_calibration_files(calibration_path, max_calibration_images=500):
+    """Lists the image files of the 'uploads' folder used for INT8 calibration, a fixed random sample of at most
+    'max_calibration_images' files so the calibration cost does not grow with the gallery.
+
+    Args:
+        calibration_path: absolute path of the 'uploads/' folder containing the cropped face images.
+        max_calibration_images: (int) maximum number of image files used for calibration.
+
+    Returns:
+        files: sorted list of the image file paths.
+    """
+    files = sorted(
+        path for path in glob.iglob(pathname=os.path.join(calibration_path, '*'))
+        if os.path.isfile(path) and path.rsplit('.', 1)[-1].lower() in image_signatures
+    )
+    if len(files) > max_calibration_images:
+        files = sorted(random.Random(0).sample(files, max_calibration_images))
+
+    return files
+
+
+def calibrate_int8_graph(calib_graph_def, files, image_size, max_batch_size, session_config=None):
+    """Runs face images stored in the 'uploads' folder through a TF-TRT INT8 calibration graph, then converts it
+    to the INT8 inference graph.
+
+    The images are decoded batch by batch into a reused float32 buffer, only one batch is held in memory.
+
+    Args:
+        calib_graph_def: GraphDef returned by the TF-TRT conversion in 'INT8' precision mode.
+        files: list of the cropped face image files used for calibration, see get_calibration_files().
+        image_size: (int) required square image size.
+        max_batch_size: (int) maximum batch size the TensorRT engines are built for.
+        session_config: (tf.ConfigProto) session configuration holding the GPU options of the process.
+
+    Returns:
+        graph_def: GraphDef of the calibrated INT8 FaceNet model.
+    """
+    import tensorflow.contrib.tensorrt as trt
+
+    print('Calibrating INT8 FaceNet model on %d images' % len(files))
+    batch = np.empty((max_batch_size, image_size, image_size, 3), dtype=np.float32)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(calib_graph_def, name='')
+        images_placeholder = graph.get_tensor_by_name("input:0")
+        embeddings = graph.get_tensor_by_name("embeddings:0")
+        with tf.Session(graph=graph, config=session_config) as session:
+            count = 0
+            for filename in files:
+                img = cv2.imread(filename, cv2.IMREAD_COLOR)
+                if img is None:
+                    continue
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                img = imresize(arr=img, size=(image_size, image_size), mode='RGB')
+                prewhiten(img, out=batch[count])
+                count += 1
+                if count == max_batch_size:
+                    session.run(embeddings, feed_dict={images_placeholder: batch})
+                    count = 0
+            if count > 0:
+                session.run(embeddings, feed_dict={images_placeholder: batch[:count]})
+
+            return trt.calib_graph_to_infer_graph(calib_graph_def)
+
+
+def optimize_graph_def(graph_def, model_path, precision, max_batch_size, calibration_path=None, image_size=160,
+                       session_config=None, min_calibration_images=100):
+    """Converts the frozen FaceNet graph with TensorRT (TF-TRT) so the forward pass runs as fused TensorRT engines.
+
+    The 'phase_train:0' placeholder is folded to False beforehand so the batch normalization switches are pruned and
+    the whole network can be converted. The converted graph is cached next to the frozen model file
+    ('<model>.<precision>.b<max_batch_size>.pb'), subsequent startups load it directly instead of rebuilding the
+    engines. For 'INT8' the cached graph holds the calibrated engines, so calibration only runs once.
+    The cache file is written to a temporary file first and then renamed, so concurrently starting workers never
+    read a partially written graph; an unreadable cache file is rebuilt.
+
+    If 'INT8' calibration is not possible, e.g. the 'uploads' folder holds fewer than 'min_calibration_images' images
+    (checked before any conversion), the graph is converted in 'FP16' instead. If TensorRT is not available the
+    original graph is returned unchanged.
+
+    Args:
+        graph_def: GraphDef of the frozen FaceNet model.
+        model_path: path of the frozen FaceNet model protocol buffer file.
+        precision: (string) TensorRT precision mode: 'FP16' or 'INT8'.
+        max_batch_size: (int) maximum batch size the TensorRT engines are built for.
+        calibration_path: absolute path of the folder with the face images used for 'INT8' calibration.
+        image_size: (int) required square image size.
+        session_config: (tf.ConfigProto) session configuration holding the GPU options of the process, the
+                        conversion is the first GPU initialization so it determines the GPU allocator options.
+        min_calibration_images: (int) minimum number of face images required for 'INT8' calibration.
+
+    Returns:
+        graph_def: GraphDef of the TensorRT optimized FaceNet model.
+    """
+    cache_path = '%s.%s.b%d.pb' % (os.path.splitext(model_path)[0], precision, max_batch_size)
+    if os.path.isfile(cache_path):
+        try:
+            with gfile.FastGFile(cache_path, 'rb') as f:
+                trt_graph_def = tf.GraphDef()
+                trt_graph_def.ParseFromString(f.read())
+            if precision == 'INT8':
+                print('Reusing calibrated INT8 TensorRT model %s, delete it to recalibrate on the current uploads'
+                      % cache_path)
+            else:
+                print('TensorRT model filename: %s' % cache_path)
+
+            return trt_graph_def
+
+        except Exception as e:
+            print('Cached TensorRT model %s is unreadable, rebuilding it: %s' % (cache_path, str(e)))
+
+    if precision == 'INT8':
+        calibration_files = get_calibration_files(calibration_path=calibration_path) if calibration_path else []
+        if len(calibration_files) < min_calibration_images:
+            print('INT8 calibration requires at least %d face images in %s, found %d; converting in FP16 instead' % (
+                min_calibration_images, calibration_path, len(calibration_files)))
+
+            return optimize_graph_def(
+                graph_def=graph_def,
+                model_path=model_path,
+                precision='FP16',
+                max_batch_size=max_batch_size,
+                session_config=session_config
+            )
+
+    try:
+        import tensorflow.contrib.tensorrt as trt
+
+        # Fold 'phase_train:0' to False so the training branches of the batch normalization layers are pruned
+        with tf.Graph().as_default() as graph:
+            phase_train = tf.constant(False, dtype=tf.bool, name='phase_train_folded')
+            tf.import_graph_def(graph_def, input_map={'phase_train:0': phase_train}, name='')
+            folded_graph_def = graph.as_graph_def()
+
+        trt_graph_def = trt.create_inference_graph(
+            input_graph_def=folded_graph_def,
+            outputs=['embeddings'],
+            max_batch_size=max_batch_size,
+            max_workspace_size_bytes=1 << 30,
+            precision_mode=precision,
+            session_config=session_config
+        )
+        if precision == 'INT8':
+            trt_graph_def = calibrate_int8_graph(
+                calib_graph_def=trt_graph_def,
+                files=calibration_files,
+                image_size=image_size,
+                max_batch_size=max_batch_size,
+                session_config=session_config
+            )
+
+        # Per-process temporary file, renamed atomically once completely written
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        with gfile.FastGFile(tmp_path, 'wb') as f:
+            f.write(trt_graph_def.SerializeToString())
+        os.replace(tmp_path, cache_path)
+
+        return trt_graph_def
+
+    except Exception as e:
+        if precision == 'INT8':
+            print('INT8 calibration failed, converting the FaceNet graph in FP16 instead: %s' % str(e))
+
+            return optimize_graph_def(
+                graph_def=graph_def,
+                model_path=model_path,
+                precision='FP16',
+                max_batch_size=max_batch_size,
+                session_config=session_config
+            )
+
+        print('TensorRT optimization unavailable, using the original FaceNet graph: %s' % str(e))
+
+        return graph_def
+
+
+def load_model(model, precision='FP32', max_batch_size=1, calibration_path=None, session_config=None):
     """Loads the FaceNet model from its directory path.
 
     Checks if the model is a model directory (containing a metagraph and a checkpoint file)
-    or if it is a protocol buffer file with a frozen graph.
+    or if it is a protocol buffer file with a frozen graph. A frozen graph is optimized with TensorRT
+    if a precision other than 'FP32' is requested.
 
     Note: This is a modified function from the facenet.py load_model() function in the lib directory to return
     the graph object.
 
     Args:
         model: model path
+        precision: (string) 'FP32' runs the plain Tensorflow graph, 'FP16' or 'INT8' convert the graph with TensorRT.
+        max_batch_size: (int) maximum batch size of the TensorRT engines.
+        calibration_path: absolute path of the folder with the face images used for 'INT8' calibration.
+        session_config: (tf.ConfigProto) session configuration used by the TensorRT conversion.
 
     Returns:
         graph: Tensorflow graph object of the model
@@ -83,8 +460,18 @@ def load_model(model):
         with gfile.FastGFile(model_exp, 'rb') as f:
             graph_def = tf.GraphDef()
             graph_def.ParseFromString(f.read())
-            graph = tf.import_graph_def(graph_def, name='')
-            return graph
+        if precision != 'FP32':
+            graph_def = optimize_graph_def(
+                graph_def=graph_def,
+                model_path=model_exp,
+                precision=precision,
+                max_batch_size=max_batch_size,
+                calibration_path=calibration_path,
+                session_config=session_config
+            )
+        graph = tf.import_graph_def(graph_def, name='')
+
+        return graph
     else:
         print('Model directory: %s' % model_exp)
         meta_file, ckpt_file = get_model_filenames(model_exp)
@@ -98,7 +485,7 @@ def load_model(model):
         return graph
 
 
-def get_face(img, pnet, rnet, onet, image_size):
+def get_face(img, pnet, rnet, onet, image_size, max_detection_size=None):
     """Crops an image containing a single human face from the input image if it exists; using a Multi-Task Cascading
     Convolutional neural network, then resizes the image to the required image size: default = (160 x 160 x 3).
     If no face is detected, it returns a null value.
@@ -109,6 +496,8 @@ def get_face(img, pnet, rnet, onet, image_size):
           rnet: refinement net, second stage of the MTCNN face detection
           onet: output net,  third stage of the MTCNN face detection
           image_size: (int) required square image size
+          max_detection_size: (int) longest image side the MTCNN runs on, larger images are downscaled for a faster
+                              detection at the cost of missing small faces (see below); None disables downscaling.
 
     Returns:
           face_img: an image containing a face of image_size: default = (160 x 160 x 3)
@@ -120,16 +509,34 @@ def get_face(img, pnet, rnet, onet, image_size):
     factor = 0.709
     margin = 44
     input_image_size = image_size
+    # With 'max_detection_size' set, larger images are downscaled so the image pyramid has fewer and smaller scales;
+    # the face is still cropped from the full resolution image.
+    # Trade-off: 'minsize' applies to the downscaled image, so the smallest detectable face in the original image
+    # grows to minsize / detection_scale pixels. The downscale is capped so that it never exceeds
+    # 'max_effective_minsize' pixels, large photos are then detected at more than 'max_detection_size'.
+    max_effective_minsize = 60
 
     img_size = np.asarray(img.shape)[0:2]
+    detection_scale = 1.0
+    if max_detection_size:
+        detection_scale = max(float(max_detection_size) / np.max(img_size), float(minsize) / max_effective_minsize)
+        detection_scale = min(1.0, detection_scale)
+    detection_img = img
+    if detection_scale < 1.0:
+        detection_img = cv2.resize(
+            src=img,
+            dsize=(int(round(img_size[1] * detection_scale)), int(round(img_size[0] * detection_scale))),
+            interpolation=cv2.INTER_AREA
+        )
+
     bounding_boxes, _ = detect_face(
-        img=img, minsize=minsize, pnet=pnet, rnet=rnet,
+        img=detection_img, minsize=minsize, pnet=pnet, rnet=rnet,
         onet=onet, threshold=threshold, factor=factor
     )
 
     if not len(bounding_boxes) == 0:
         for face in bounding_boxes:
-            det = np.squeeze(face[0:4])
+            det = np.squeeze(face[0:4]) / detection_scale
             bb = np.zeros(4, dtype=np.int32)
             bb[0] = np.maximum(det[0] - margin / 2, 0)
             bb[1] = np.maximum(det[1] - margin / 2, 0)
@@ -195,7 +602,8 @@ def forward_pass(img, session, images_placeholder, phase_train_placeholder, embe
         img: image file (numpy array).
         session: The active Tensorflow session.
         images_placeholder: placeholder of the 'input:0' tensor of the pre-trained FaceNet model graph.
-        phase_train_placeholder: placeholder of the 'phase_train:0' tensor of the pre-trained FaceNet model graph.
+        phase_train_placeholder: placeholder of the 'phase_train:0' tensor of the pre-trained FaceNet model graph,
+                                 None if it was folded into the graph by the TensorRT optimization.
         embeddings: placeholder of the 'embeddings:0' tensor from the pre-trained FaceNet model graph.
         image_size: (int) required square image size.
 
@@ -210,7 +618,9 @@ def forward_pass(img, session, images_placeholder, phase_train_placeholder, embe
             do_prewhiten=True, image_size=image_size
         )
         # Run forward pass on FaceNet model to calculate embedding
-        feed_dict = {images_placeholder: image, phase_train_placeholder: False}
+        feed_dict = {images_placeholder: image}
+        if phase_train_placeholder is not None:
+            feed_dict[phase_train_placeholder] = False
         embedding = session.run(embeddings, feed_dict=feed_dict)
         return embedding
 
@@ -218,68 +628,306 @@ def forward_pass(img, session, images_placeholder, phase_train_placeholder, embe
         return None
 
 
-def save_embedding(embedding, filename, embeddings_path):
-    """Saves the embedding numpy file to the 'embeddings' folder.
+class EmbeddingBatcher(object):
+    """Coalesces concurrent forward passes into batched runs of the FaceNet model.
+
+    Images submitted from the request threads are queued; a single worker thread drains up to 'max_batch_size'
+    images (waiting at most 'timeout' seconds for the batch to fill up), feeds them to the FaceNet model in one
+    session run and hands every caller its own row of the resulting embeddings.
+    """
+
+    def __init__(self, session, images_placeholder, phase_train_placeholder, embeddings, image_size,
+                 max_batch_size=16, timeout=0.005):
+        """
+        Args:
+            session: The active Tensorflow session.
+            images_placeholder: placeholder of the 'input:0' tensor of the pre-trained FaceNet model graph.
+            phase_train_placeholder: placeholder of the 'phase_train:0' tensor of the pre-trained FaceNet model graph,
+                                     None if it was folded into the graph by the TensorRT optimization.
+            embeddings: placeholder of the 'embeddings:0' tensor from the pre-trained FaceNet model graph.
+            image_size: (int) required square image size.
+            max_batch_size: (int) maximum number of images fed to the FaceNet model in one session run.
+            timeout: (float) seconds to wait for more images before running an incomplete batch.
+        """
+        self.session = session
+        self.images_placeholder = images_placeholder
+        self.phase_train_placeholder = phase_train_placeholder
+        self.embeddings = embeddings
+        self.image_size = image_size
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        # Pre-compile the forward pass once, so every batch skips the per-call feed and fetch processing of run()
+        feed_list = [images_placeholder]
+        if phase_train_placeholder is not None:
+            feed_list.append(phase_train_placeholder)
+        self._forward = session.make_callable(fetches=embeddings, feed_list=feed_list)
+        # Reused contiguous float32 input buffer in the (B x 160 x 160 x 3) layout of the 'input:0' placeholder,
+        # so batches are fed without concatenation or a float64 -> float32 conversion of the whole batch
+        self._images = np.empty((max_batch_size, image_size, image_size, 3), dtype=np.float32)
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='facenet-batcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, img):
+        """Queues a (160 x 160 x 3) face image for the next batched forward pass.
+
+        Args:
+            img: image file (numpy array).
+
+        Returns:
+            future: concurrent.futures.Future resolving to the (1 x 128) embedding of the image.
+        """
+        future = Future()
+        self._queue.put((img, future))
+
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            futures = []
+            # Normalize the pixel values of the images in-place into the rows of the (B x 160 x 160 x 3) input buffer,
+            # an image that fails only fails its own caller and is dropped from the batch
+            for (img, future) in self._next_batch():
+                try:
+                    if img.ndim == 2:
+                        img = to_rgb(img)
+                    img = crop(img, False, self.image_size)
+                    prewhiten(img, out=self._images[len(futures)])
+                    futures.append(future)
+                except Exception as e:
+                    future.set_exception(e)
+
+            if not futures:
+                continue
+
+            try:
+                images = self._images[:len(futures)]
+                if self.phase_train_placeholder is not None:
+                    embeddings = self._forward(images, False)
+                else:
+                    embeddings = self._forward(images)
+
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for i, future in enumerate(futures):
+                future.set_result(embeddings[i:i + 1])
+
+
+def save_embedding(embedding, filename, embeddings_path, gallery=None):
+    """Saves the embedding to the gallery files in the 'embeddings' folder.
 
     Args:
         embedding: numpy array of 128 values after the image is fed to the FaceNet model.
         filename: filename of the image file.
         embeddings_path: absolute path of the 'embeddings/' folder.
+        gallery: (EmbeddingGallery) gallery of the 'embeddings' folder, opened for this call if not given.
     """
     # Save embedding of image using filename
-    path = os.path.join(embeddings_path, str(filename))
     try:
-        np.save(path, embedding)
+        if gallery is None:
+            gallery = EmbeddingGallery(embeddings_path=embeddings_path)
+        gallery.add(name=str(filename), embedding=embedding)
 
     except Exception as e:
         print(str(e))
 
 
-def load_embeddings():
-    """Loads embedding numpy files in the 'embedding' folder into a defaultdict object and returns it.
+class EmbeddingGallery(object):
+    """Embeddings of the stored identities as one (N x 128) float32 matrix plus a parallel list of names, so
+    identifying a face is a single matrix-vector product instead of a directory scan.
 
-    Returns:
-        embedding_dict: defaultdict containing the embedding file name and its numpy array contents.
+    The matrix is persisted in 'embeddings/gallery.npy', memory-mapped and pre-sized to a capacity that doubles when
+    it is full, the names in 'embeddings/names.json'. Both files are only opened again when 'names.json' changes,
+    i.e. when another process added an embedding. Embedding numpy files of the former one file per identity layout
+    are imported when the gallery files are first created.
     """
-    embedding_dict = defaultdict()
-
-    for embedding in glob.iglob(pathname='embeddings/*.npy'):
-        name = remove_file_extension(embedding)
-        dict_embedding = np.load(embedding)
-        embedding_dict[name] = dict_embedding
-
-    return embedding_dict
-
-
-def identify_face(embedding, embedding_dict):
-    """Compares its received embedding with the embeddings stored in the 'embeddings' folder  by
-    minimum euclidean distance (norm), the embedding with the least euclidean distance is the predicted class.
-
-    If all embeddings have a distance above the distance threshold (1.1), then the class of the image does not exist
-    in the embeddings folder.
 
-    Args:
-        embedding: (numpy array) containing the embedding that will be compared to the stored embeddings by euclidean
-                   distance.
-        embedding_dict: (defaultdict) containing the embedding file name and its numpy array contents.
-
-    Returns:
-          result: (string) describes the most likely person that the image looks like, or that the face
-                  does not exist in the database if the resulting euclidean distance is above the threshold.
-    """
-    min_distance = 100
-    try:
-        for (name, dict_embedding) in embedding_dict.items():
-            # Compute euclidean distance between current embedding and the embeddings from the 'embeddings' folder
-            distance = np.linalg.norm(embedding - dict_embedding)
-
-            if distance < min_distance:
-                min_distance = distance
-                identity = name
-
-        if min_distance <= 1.1:
-            # remove 'embeddings/' from identity
-            identity = identity[11:]
+    def __init__(self, embeddings_path, threshold=1.1, initial_capacity=1024):
+        """
+        Args:
+            embeddings_path: absolute path of the 'embeddings/' folder.
+            threshold: (float) maximum euclidean distance for a face to be identified as a stored identity.
+            initial_capacity: (int) number of rows the gallery file is pre-sized to.
+        """
+        self.embeddings_path = embeddings_path
+        self.threshold = threshold
+        self.initial_capacity = initial_capacity
+        self.gallery_file = os.path.join(embeddings_path, 'gallery.npy')
+        self.names_file = os.path.join(embeddings_path, 'names.json')
+        self.lock_file = os.path.join(embeddings_path, 'gallery.lock')
+        self._lock = threading.RLock()
+        self._storage = None
+        self._names = []
+        self._stamp = None
+        os.makedirs(embeddings_path, exist_ok=True)
+        with self._lock, self._file_lock():
+            if not os.path.isfile(self.names_file):
+                self._import_embedding_files()
+            self.reload()
+
+    @contextmanager
+    def _file_lock(self):
+        # Serializes gallery writes of all processes sharing the 'embeddings' folder (e.g. gunicorn workers)
+        with open(self.lock_file, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _import_embedding_files(self):
+        names = []
+        rows = []
+        for path in sorted(glob.iglob(pathname=os.path.join(self.embeddings_path, '*.npy'))):
+            if os.path.abspath(path) == os.path.abspath(self.gallery_file):
+                continue
+            try:
+                rows.append(np.load(path).astype(np.float32).reshape(-1))
+                names.append(remove_file_extension(os.path.basename(path)))
+            except Exception as e:
+                print(str(e))
+
+        if rows:
+            print('Importing %d embedding files into %s' % (len(rows), self.gallery_file))
+            self._reserve(size=len(rows), dim=rows[0].size)
+            self._storage[:len(rows)] = np.stack(rows)
+            self._storage.flush()
+            self._write_names(names)
+            self._names = names
+
+    def _reserve(self, size, dim):
+        # Grow the gallery file by doubling its capacity, so appending rows is amortized O(1)
+        if self._storage is not None and self._storage.shape[0] >= size:
+            return
+
+        capacity = self.initial_capacity if self._storage is None else self._storage.shape[0]
+        while capacity < size:
+            capacity *= 2
+
+        tmp_file = self.gallery_file + '.tmp'
+        storage = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(capacity, dim))
+        if self._storage is not None:
+            storage[:len(self._names)] = self._storage[:len(self._names)]
+        storage.flush()
+        del storage
+        self._storage = None
+        os.replace(tmp_file, self.gallery_file)
+        self._storage = np.load(self.gallery_file, mmap_mode='r+')
+
+    def _names_stamp(self):
+        # 'names.json' is replaced through a new inode on every write, so the inode tells writes apart even when they
+        # fall within one tick of a coarse modification time
+        stat = os.stat(self.names_file)
+
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _write_names(self, names):
+        tmp_file = self.names_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(names, f)
+        os.replace(tmp_file, self.names_file)
+
+    def reload(self):
+        """Memory-maps the gallery files of the 'embeddings' folder."""
+        with self._lock:
+            if not os.path.isfile(self.names_file):
+                self._storage = None
+                self._names = []
+                self._stamp = None
+                return
+
+            stamp = self._names_stamp()
+            with open(self.names_file) as f:
+                names = json.load(f)
+            self._storage = np.load(self.gallery_file, mmap_mode='r+')
+            self._names = names
+            self._stamp = stamp
+
+    def _refresh(self):
+        try:
+            stamp = self._names_stamp() if os.path.isfile(self.names_file) else None
+            if stamp != self._stamp:
+                self.reload()
+        except (OSError, ValueError) as e:
+            print(str(e))
+
+    def add(self, name, embedding):
+        """Adds an embedding to the gallery, replacing the stored embedding of the same name.
+
+        Args:
+            name: name of the identity (image filename without the file extension).
+            embedding: numpy array of 128 values after the image is fed to the FaceNet model.
+        """
+        row = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock, self._file_lock():
+            # Pick up the embeddings added by other processes before appending
+            self._refresh()
+            names = list(self._names)
+            if name in names:
+                index = names.index(name)
+            else:
+                index = len(names)
+                names.append(name)
+
+            self._reserve(size=index + 1, dim=row.size)
+            self._storage[index] = row
+            self._storage.flush()
+            self._write_names(names)
+            self._names = names
+            self._stamp = self._names_stamp()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+
+            return len(self._names)
+
+    def identify(self, embedding):
+        """Compares the received embedding with all embeddings of the gallery; the embedding with the least
+        euclidean distance is the predicted class.
+
+        The FaceNet embeddings are L2-normalized, so ||a - b|| = sqrt(2 - 2 * a.b) and the best match is the row with
+        the largest dot product. The reported distance is computed exactly for that single row only.
+
+        Args:
+            embedding: (numpy array) containing the embedding that will be compared to the stored embeddings.
+
+        Returns:
+              result: (string) describes the most likely person that the image looks like, or that the face
+                      does not exist in the database if the resulting euclidean distance is above the threshold.
+        """
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._refresh()
+            if not self._names:
+                return "No embedding files detected! Please upload image files for embedding!"
+
+            similarities = np.einsum('ij,j->i', self._storage[:len(self._names)], query)
+            index = int(similarities.argmax())
+            identity = self._names[index]
+            min_distance = float(np.linalg.norm(self._storage[index] - query))
+
+        if min_distance <= self.threshold:
             result = "It's " + str(identity) + ", the distance is " + str(min_distance)
 
             return result
@@ -289,7 +937,3 @@ def identify_face(embedding, embedding_dict):
 
             return result
 
-    except Exception as e:
-        print(str(e))
-
-        return str(e)